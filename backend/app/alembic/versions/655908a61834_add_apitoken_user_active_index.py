@@ -0,0 +1,47 @@
+"""Add composite index on apitoken (user_id, is_active)
+
+Revision ID: 655908a61834
+Revises: 3a8b5971fdc9
+Create Date: 2026-10-15 10:12:41.318205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel.sql.sqltypes
+
+
+# revision identifiers, used by Alembic.
+revision = '655908a61834'
+down_revision = '3a8b5971fdc9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # apitoken was created outside of migrations on existing deployments, so
+    # only create it here when it is missing
+    if not sa.inspect(op.get_bind()).has_table('apitoken'):
+        op.create_table('apitoken',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('token', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+            sa.Column('user_id', sa.Uuid(), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=False),
+            sa.Column('expires_at', sa.DateTime(), nullable=False),
+            sa.Column('is_active', sa.Boolean(), nullable=False),
+            sa.Column('request_count', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('token')
+        )
+    else:
+        # (user_id, is_active) has user_id as its left prefix and serves
+        # user_id-only lookups, so the single-column index is redundant
+        op.drop_index('ix_apitoken_user_id', table_name='apitoken', if_exists=True)
+    op.create_index('ix_apitoken_user_active', 'apitoken', ['user_id', 'is_active'], unique=False)
+
+
+def downgrade():
+    # upgrade can't record whether it created apitoken, so the table is left
+    # in place and only the indexes are put back as they were
+    op.create_index(op.f('ix_apitoken_user_id'), 'apitoken', ['user_id'], unique=False)
+    op.drop_index('ix_apitoken_user_active', table_name='apitoken')
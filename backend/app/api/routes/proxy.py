@@ -1,59 +1,63 @@
 from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks, Header
-from typing import Annotated, Dict, List, Optional
+from fastapi.responses import ORJSONResponse
+from typing import Annotated, Dict, List, Mapping, Optional, Tuple
+from types import MappingProxyType
 from pydantic import BaseModel
+from cachetools import TTLCache
 import httpx
 import logging
 import asyncio
 import time
-import random
+import itertools
+import threading
 import uuid
 from datetime import datetime, timedelta
-from app.api.deps import SessionDep, CurrentUser
+from app.api.deps import SessionDep, CurrentUser, ProxyClientDep
 from app.models import User
-from app.core.security import generate_api_key, verify_api_key
-from app.api.routes import users
+from app.core.security import generate_api_key, verify_api_key, invalidate_api_key
 from sqlalchemy.orm import Session
-from sqlmodel import SQLModel, Field
+from sqlalchemy import Index, func
+from sqlmodel import SQLModel, Field, select
 from uuid import UUID
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Define regions and their corresponding endpoints
-REGION_ENDPOINTS = {
-    "us-east": [
+REGION_ENDPOINTS: Mapping[str, Tuple[str, ...]] = MappingProxyType({
+    "us-east": (
         "https://us-east4-proxy1-454912.cloudfunctions.net/main",
         "https://us-east1-proxy1-454912.cloudfunctions.net/main",
         "https://us-east5-proxy2-455013.cloudfunctions.net/main"
-    ],
-    "us-west": [
+    ),
+    "us-west": (
         "https://us-west1-proxy1-454912.cloudfunctions.net/main",
         "https://us-west3-proxy1-454912.cloudfunctions.net/main",
         "https://us-west4-proxy1-454912.cloudfunctions.net/main",
         "https://us-west2-proxy2-455013.cloudfunctions.net/main"
-    ],
-    "us-central": [
+    ),
+    "us-central": (
         "https://us-central1-proxy1-454912.cloudfunctions.net/main",
         "https://us-central1-proxy2-455013.cloudfunctions.net/main",
         "https://us-south1-proxy3-455013.cloudfunctions.net/main"
-    ],
-    "northamerica-northeast": [
+    ),
+    "northamerica-northeast": (
         "https://northamerica-northeast1-proxy2-455013.cloudfunctions.net/main",
         "https://northamerica-northeast2-proxy2-455013.cloudfunctions.net/main"
-    ],
-    "southamerica": [
+    ),
+    "southamerica": (
         "https://southamerica-west1-proxy1-454912.cloudfunctions.net/main",
         "https://southamerica-east1-proxy3-455013.cloudfunctions.net/main",
         "https://southamerica-west1-proxy3-455013.cloudfunctions.net/main"
-    ],
-    "asia": [
+    ),
+    "asia": (
         "https://asia-east1-proxy6-455014.cloudfunctions.net/main",
         "https://asia-northeast2-proxy6-455014.cloudfunctions.net/main"
-    ],
-    "australia": [
+    ),
+    "australia": (
         "https://australia-southeast1-proxy3-455013.cloudfunctions.net/main",
         "https://australia-southeast2-proxy3-455013.cloudfunctions.net/main"
-    ],
-    "europe": [
+    ),
+    "europe": (
         "https://europe-north1-proxy4-455014.cloudfunctions.net/main",
         "https://europe-southwest1-proxy4-455014.cloudfunctions.net/main",
         "https://europe-west1-proxy4-455014.cloudfunctions.net/main",
@@ -66,21 +70,29 @@ REGION_ENDPOINTS = {
         "https://europe-west6-proxy5-455014.cloudfunctions.net/main",
         "https://europe-west9-proxy5-455014.cloudfunctions.net/main",
         "https://europe-west10-proxy6-455014.cloudfunctions.net/main"
-    ],
-    "middle-east": [
+    ),
+    "middle-east": (
         "https://me-central1-proxy6-455014.cloudfunctions.net/main",
         "https://me-west1-proxy6-455014.cloudfunctions.net/main"
-    ]
-}
+    )
+})
+
+_VALID_REGIONS = frozenset(REGION_ENDPOINTS)
+_INVALID_REGION_DETAIL = f"Invalid region. Available regions: {list(REGION_ENDPOINTS)}"
+
+# Per-region counters used to rotate the starting endpoint for /fetch
+_region_counters = {region: itertools.count() for region in REGION_ENDPOINTS}
 
 router = APIRouter(tags=["proxy"], prefix="/proxy")
 
 # APIToken Model Definition
 class APIToken(SQLModel, table=True):
     __tablename__ = "apitoken"
+    # Also serves lookups by user_id alone, so user_id has no index of its own
+    __table_args__ = (Index("ix_apitoken_user_active", "user_id", "is_active"),)
     id: Optional[int] = Field(default=None, primary_key=True)
     token: str = Field(unique=True)
-    user_id: UUID = Field(foreign_key="user.id", index=True)  # Change to UUID
+    user_id: UUID = Field(foreign_key="user.id")  # Change to UUID
     created_at: datetime = Field(default_factory=datetime.utcnow)
     expires_at: datetime
     is_active: bool = Field(default=True)
@@ -118,21 +130,22 @@ class ProxyResponse(BaseModel):
     region_used: str
 
 # Health check function
-async def check_proxy_health(endpoint: str, region: str) -> Dict:
+HEALTH_CHECK_TIMEOUT = 0.5
+
+async def check_proxy_health(client: httpx.AsyncClient, endpoint: str, region: str) -> Dict:
     start_time = time.time()
     try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            response = await client.get(f"{endpoint}/health")
-            response.raise_for_status()
-            response_time = time.time() - start_time
-            return {
-                "region": region,
-                "is_healthy": True,
-                "response_time": response_time,
-                "last_checked": datetime.utcnow()
-            }
+        response = await client.get(f"{endpoint}/health", timeout=HEALTH_CHECK_TIMEOUT)
+        response.raise_for_status()
+        response_time = time.time() - start_time
+        return {
+            "region": region,
+            "is_healthy": True,
+            "response_time": response_time,
+            "last_checked": datetime.utcnow()
+        }
     except Exception as e:
-        logger.error(f"Health check failed for {endpoint} in {region}: {str(e)}")
+        logger.error("Health check failed for %s in %s: %s", endpoint, region, e)
         return {
             "region": region,
             "is_healthy": False,
@@ -140,6 +153,103 @@ async def check_proxy_health(endpoint: str, region: str) -> Dict:
             "last_checked": datetime.utcnow()
         }
 
+PROXY_FETCH_TIMEOUT = httpx.Timeout(10.0, connect=2.0)
+# Budget for one /fetch across all failover attempts, close to the ~15 s
+# worst case it had before failover
+PROXY_FETCH_DEADLINE = 15.0
+STATUS_DEADLINE = 0.5
+
+# Health results are cached per endpoint so /status doesn't re-probe
+# every endpoint on every request. Entries map endpoint -> (checked_at, result)
+# where checked_at comes from time.monotonic().
+HEALTH_CACHE_TTL = 5.0
+_health_cache: Dict[str, tuple[float, Dict]] = {}
+_health_locks: Dict[str, asyncio.Lock] = {}
+
+async def _refresh_health(client: httpx.AsyncClient, endpoint: str, region: str, ttl: float) -> Dict:
+    # One probe per endpoint at a time; concurrent callers wait on the lock and
+    # pick up the fresh result instead of probing again.
+    lock = _health_locks.setdefault(endpoint, asyncio.Lock())
+    async with lock:
+        cached = _health_cache.get(endpoint)
+        if cached and time.monotonic() - cached[0] < ttl:
+            return cached[1]
+        result = await check_proxy_health(client, endpoint, region)
+        _health_cache[endpoint] = (time.monotonic(), result)
+        return result
+
+async def get_cached_health(
+    client: httpx.AsyncClient,
+    endpoint: str,
+    region: str,
+    ttl: float = HEALTH_CACHE_TTL
+) -> Dict:
+    cached = _health_cache.get(endpoint)
+    if cached and time.monotonic() - cached[0] < ttl:
+        return cached[1]
+    return await _refresh_health(client, endpoint, region, ttl)
+
+def _fresh_health(endpoint: str) -> Optional[Dict]:
+    # Last result for an endpoint, or None if it is missing or older than the TTL
+    cached = _health_cache.get(endpoint)
+    if cached and time.monotonic() - cached[0] < HEALTH_CACHE_TTL:
+        return cached[1]
+    return None
+
+# /fetch failures only demote an endpoint in the /fetch order. They stay out
+# of _health_cache, since the failure may come from the customer's target URL
+# and /status should keep reporting what the /health probes saw. Entries map
+# endpoint -> time.monotonic() of the last failure.
+_fetch_demotions: Dict[str, float] = {}
+
+def _demote_for_fetch(endpoint: str) -> None:
+    _fetch_demotions[endpoint] = time.monotonic()
+
+def _is_known_healthy(endpoint: str) -> bool:
+    # Endpoints without a fresh result count as healthy, so a past failure
+    # only pushes an endpoint back until its entry expires
+    failed_at = _fetch_demotions.get(endpoint)
+    if failed_at is not None and time.monotonic() - failed_at < HEALTH_CACHE_TTL:
+        return False
+    result = _fresh_health(endpoint)
+    return result is None or result["is_healthy"]
+
+# Smoothed /fetch latency per endpoint, for the power-of-two choice. Entries
+# map endpoint -> (updated_at, ewma_seconds). A sample older than
+# FETCH_LATENCY_TTL is dropped, so one slow spell can't keep an endpoint
+# from leading indefinitely.
+FETCH_LATENCY_ALPHA = 0.3
+FETCH_LATENCY_TTL = 60.0
+_fetch_latency: Dict[str, tuple[float, float]] = {}
+
+def _record_fetch_latency(endpoint: str, seconds: float) -> None:
+    now = time.monotonic()
+    previous = _fetch_latency.get(endpoint)
+    if previous and now - previous[0] < FETCH_LATENCY_TTL:
+        seconds = FETCH_LATENCY_ALPHA * seconds + (1 - FETCH_LATENCY_ALPHA) * previous[1]
+    _fetch_latency[endpoint] = (now, seconds)
+
+def _fetch_latency_estimate(endpoint: str) -> float:
+    # Endpoints without a recent sample count as fast so they get tried
+    entry = _fetch_latency.get(endpoint)
+    if entry and time.monotonic() - entry[0] < FETCH_LATENCY_TTL:
+        return entry[1]
+    return 0.0
+
+def _mark_unhealthy(endpoint: str, region: str, response_time: float) -> Dict:
+    result = {
+        "region": region,
+        "is_healthy": False,
+        "response_time": response_time,
+        "last_checked": datetime.utcnow()
+    }
+    _health_cache[endpoint] = (time.monotonic(), result)
+    return result
+
+# Users resolved from API keys, kept briefly to skip a DB lookup per request
+_user_cache: TTLCache = TTLCache(maxsize=1024, ttl=30)
+_user_cache_lock = threading.Lock()
+
 # Custom dependency for API key verification
 async def verify_api_token(
     session: SessionDep,
@@ -152,7 +262,20 @@ async def verify_api_token(
     if not token_data or "user_id" not in token_data:
         raise HTTPException(status_code=401, detail="Invalid API key")
     
-    user = users.read_user_by_id(session=session, user_id=token_data["user_id"], current_user=CurrentUser)
+    try:
+        user_id = uuid.UUID(token_data["user_id"])
+    except ValueError:
+        raise HTTPException(status_code=401, detail="Invalid API key")
+    
+    with _user_cache_lock:
+        user = _user_cache.get(user_id)
+    if user is None:
+        user = session.get(User, user_id)
+        if user:
+            # Detach so the cached instance isn't expired by later commits
+            session.expunge(user)
+            with _user_cache_lock:
+                _user_cache[user_id] = user
     if not user or not user.is_active:
         raise HTTPException(status_code=401, detail="Invalid or inactive user")
     
@@ -192,18 +315,38 @@ async def list_regions(
 async def get_proxy_status(
     region: str,
     user: Annotated[User, Depends(verify_api_token)],
-    session: SessionDep
+    session: SessionDep,
+    client: ProxyClientDep
 ):
-    if region not in REGION_ENDPOINTS:
-        raise HTTPException(status_code=400, detail=f"Invalid region. Available regions: {list(REGION_ENDPOINTS.keys())}")
+    if region not in _VALID_REGIONS:
+        raise HTTPException(status_code=400, detail=_INVALID_REGION_DETAIL)
     
+    # Don't let one unreachable endpoint hold up the whole reply: whatever
+    # hasn't answered by the deadline is cancelled and reported unhealthy.
     endpoints = REGION_ENDPOINTS[region]
-    status_tasks = [check_proxy_health(endpoint, region) for endpoint in endpoints]
-    results = await asyncio.gather(*status_tasks)
+    status_tasks = {
+        asyncio.create_task(get_cached_health(client, endpoint, region)): endpoint
+        for endpoint in endpoints
+    }
+    _, pending = await asyncio.wait(status_tasks, timeout=STATUS_DEADLINE)
+    
+    # Aggregate in the same pass that collects the results
+    healthy_count = 0
+    total_response_time = 0.0
+    last_checked = None
+    for task, endpoint in status_tasks.items():
+        if task in pending:
+            task.cancel()
+            result = _mark_unhealthy(endpoint, region, STATUS_DEADLINE)
+        else:
+            result = task.result()
+        healthy_count += result["is_healthy"]
+        total_response_time += result["response_time"]
+        if last_checked is None:
+            last_checked = result["last_checked"]
     
-    healthy_count = sum(1 for r in results if r["is_healthy"])
     total_count = len(endpoints)
-    avg_response_time = sum(r["response_time"] for r in results) / total_count if total_count > 0 else 0
+    avg_response_time = total_response_time / total_count if total_count > 0 else 0
     
     status = ProxyStatus(
         region=region,
@@ -211,7 +354,7 @@ async def get_proxy_status(
         avg_response_time=avg_response_time,
         healthy_endpoints=healthy_count,
         total_endpoints=total_count,
-        last_checked=results[0]["last_checked"] if results else datetime.utcnow()
+        last_checked=last_checked or datetime.utcnow()
     )
     return ProxyStatusResponse(statuses=[status])
 
@@ -222,10 +365,11 @@ async def proxy_fetch(
     request: ProxyRequest,
     user: Annotated[User, Depends(verify_api_token)],
     background_tasks: BackgroundTasks,
+    client: ProxyClientDep,
     x_api_key: Annotated[str, Header()] = None
 ):
-    if region not in REGION_ENDPOINTS:
-        raise HTTPException(status_code=400, detail=f"Invalid region. Available regions: {list(REGION_ENDPOINTS.keys())}")
+    if region not in _VALID_REGIONS:
+        raise HTTPException(status_code=400, detail=_INVALID_REGION_DETAIL)
     
     # Verify and increment request counter
     token = session.query(APIToken).filter(
@@ -236,22 +380,58 @@ async def proxy_fetch(
     if not token:
         raise HTTPException(status_code=401, detail="Invalid API key")
     
+    # Try endpoints one at a time, round-robin, instead of probing the whole
+    # region first. Endpoints the health cache last saw failing go to the back.
     endpoints = REGION_ENDPOINTS[region]
-    status_tasks = [check_proxy_health(endpoint, region) for endpoint in endpoints]
-    results = await asyncio.gather(*status_tasks)
-    
-    healthy_endpoints = [endpoints[i] for i, result in enumerate(results) if result["is_healthy"]]
-    if not healthy_endpoints:
-        raise HTTPException(status_code=503, detail=f"No healthy proxy endpoints available in {region}")
-    
-    selected_endpoint = random.choice(healthy_endpoints)
+    start = next(_region_counters[region]) % len(endpoints)
+    candidates = sorted(
+        endpoints[start:] + endpoints[:start],
+        key=lambda endpoint: not _is_known_healthy(endpoint)
+    )
+    # Power of two choices: of the first two candidates, lead with the one
+    # whose recent /fetch calls answered faster
+    if (
+        len(candidates) > 1
+        and _is_known_healthy(candidates[1])
+        and _fetch_latency_estimate(candidates[1]) < _fetch_latency_estimate(candidates[0])
+    ):
+        candidates[0], candidates[1] = candidates[1], candidates[0]
     
-    try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.post(
-                f"{selected_endpoint}/fetch",
-                json={"url": request.url}
+    # Only fail over when the request never reached the endpoint or the
+    # endpoint answered 5xx. A read timeout means the upstream fetch already
+    # started, so it isn't repeated elsewhere. All attempts share one deadline.
+    deadline = time.monotonic() + PROXY_FETCH_DEADLINE
+    for endpoint in candidates:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        start_time = time.monotonic()
+        try:
+            response = await asyncio.wait_for(
+                client.post(
+                    f"{endpoint}/fetch",
+                    json={"url": request.url},
+                    timeout=PROXY_FETCH_TIMEOUT
+                ),
+                timeout=remaining
             )
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            logger.error("Proxy fetch via %s in %s failed: %s", endpoint, region, e)
+            _demote_for_fetch(endpoint)
+            continue
+        except asyncio.TimeoutError:
+            logger.error("Proxy fetch in %s timed out after %ss", region, PROXY_FETCH_DEADLINE)
+            raise HTTPException(status_code=504, detail=f"Proxy request timed out in {region}")
+        except httpx.HTTPError as e:
+            logger.error("Proxy fetch failed in %s: %s", region, e)
+            raise HTTPException(status_code=500, detail=f"Proxy request failed in {region}: {str(e)}")
+        if response.status_code >= 500:
+            logger.error("Proxy fetch via %s in %s failed: HTTP %s", endpoint, region, response.status_code)
+            _demote_for_fetch(endpoint)
+            continue
+        _record_fetch_latency(endpoint, time.monotonic() - start_time)
+        
+        try:
             response.raise_for_status()
             data = response.json()
             
@@ -265,32 +445,52 @@ async def proxy_fetch(
                 device_id=data["device_id"],
                 region_used=region
             )
-    except Exception as e:
-        logger.error(f"Proxy fetch failed in {region}: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Proxy request failed in {region}: {str(e)}")
+        except Exception as e:
+            logger.error("Proxy fetch failed in %s: %s", region, e)
+            raise HTTPException(status_code=500, detail=f"Proxy request failed in {region}: {str(e)}")
+    
+    raise HTTPException(status_code=503, detail=f"No healthy proxy endpoints available in {region}")
 
 FRONT_PREVIEW_LENGTH = 8
 END_PREVIEW_LENGTH = 8
 
-@router.get("/api-keys", response_model=List[APIKeyResponse])
-async def list_user_api_keys(session: SessionDep, current_user: CurrentUser):
+@router.get("/api-keys", response_model=List[APIKeyResponse], response_class=ORJSONResponse)
+async def list_user_api_keys(
+    session: SessionDep,
+    current_user: CurrentUser,
+    skip: int = 0,
+    limit: int = 100
+):
     if not current_user.has_subscription:
         raise HTTPException(status_code=403, detail="Active subscription required")
     
-    api_tokens = session.query(APIToken).filter(
-        APIToken.user_id == str(current_user.id),
-        APIToken.is_active == True
-    ).all()
+    # Served by ix_apitoken_user_active; rows are streamed in batches. Only
+    # the preview ends of each token are read, never the full token.
+    statement = (
+        select(
+            func.left(APIToken.token, FRONT_PREVIEW_LENGTH),
+            func.right(APIToken.token, END_PREVIEW_LENGTH),
+            APIToken.created_at,
+            APIToken.expires_at,
+            APIToken.is_active,
+            APIToken.request_count
+        )
+        .where(APIToken.user_id == current_user.id, APIToken.is_active == True)
+        .order_by(APIToken.created_at.desc())
+        .offset(skip)
+        .limit(limit)
+        .execution_options(yield_per=100)
+    )
     
     key_list = [
         {
-            "key_preview": f"{token.token[:FRONT_PREVIEW_LENGTH]}...{token.token[-END_PREVIEW_LENGTH:]}",
-            "created_at": token.created_at.isoformat(),
-            "expires_at": token.expires_at.isoformat(),
-            "is_active": token.is_active,
-            "request_count": token.request_count
+            "key_preview": f"{front}...{end}",
+            "created_at": created_at.isoformat(),
+            "expires_at": expires_at.isoformat(),
+            "is_active": is_active,
+            "request_count": request_count
         }
-        for token in api_tokens
+        for front, end, created_at, expires_at, is_active, request_count in session.exec(statement)
     ]
     return key_list
 # Add this new endpoint after your existing /api-keys GET endpoint
@@ -314,7 +514,7 @@ async def delete_api_key(
     ).first()
 
     if not token:
-        logger.info(f"API key deletion attempted but not found. User: {current_user.id}, Preview: {key_preview_short}")
+        logger.info("API key deletion attempted but not found. User: %s, Preview: %s", current_user.id, key_preview_short)
         raise HTTPException(status_code=404, detail="API key not found")
 
     # Prepare user data with only existing fields
@@ -338,6 +538,7 @@ async def delete_api_key(
     # Delete the token
     session.delete(token)
     session.commit()
+    invalidate_api_key(token_data["full_token"])
 
     def send_deletion_notification():
         try:
@@ -376,10 +577,10 @@ async def delete_api_key(
             if not email_success:
                 logger.error("Failed to send API key deletion notification email")
             else:
-                logger.info(f"Deletion notification sent for token {token_data['token_preview']}")
+                logger.info("Deletion notification sent for token %s", token_data['token_preview'])
                 
         except Exception as e:
-            logger.error(f"Error sending deletion notification email: {str(e)}")
+            logger.error("Error sending deletion notification email: %s", e)
 
     background_tasks.add_task(send_deletion_notification)
     return None
\ No newline at end of file
@@ -0,0 +1,25 @@
+import httpx
+from fastapi import Request
+
+# Shared pool for outbound calls to the proxy endpoints. Keeping connections
+# alive avoids a TCP+TLS handshake on every health probe and fetch. With
+# HTTP/2, concurrent requests to the same origin multiplex over a single
+# connection, so idle connections are kept for a minute between bursts.
+PROXY_CLIENT_TIMEOUT = httpx.Timeout(5.0, connect=2.0)
+PROXY_CLIENT_LIMITS = httpx.Limits(
+    max_keepalive_connections=100,
+    max_connections=200,
+    keepalive_expiry=60.0,
+)
+
+
+def create_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=PROXY_CLIENT_TIMEOUT,
+        limits=PROXY_CLIENT_LIMITS,
+        http2=True,
+    )
+
+
+def get_client(request: Request) -> httpx.AsyncClient:
+    return request.app.state.proxy_client
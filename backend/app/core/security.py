@@ -1,43 +1,120 @@
 # app/core/security.py
-from datetime import datetime, timedelta, timezone
+from datetime import timedelta
 from typing import Any, Optional, Dict
+import base64
+import hashlib
+import hmac
+import threading
+import time
 import jwt
+import orjson
+from cachetools import LRUCache, TTLCache
 from passlib.context import CryptContext
-from jose import JWTError
 from app.core.config import settings
 
-# Password hashing context
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing context: new hashes use argon2id, existing bcrypt hashes
+# still verify
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    deprecated="auto",
+    argon2__rounds=2,
+    argon2__memory_cost=65536,
+    argon2__parallelism=1,
+)
 ALGORITHM = "HS256"
+API_KEY_EXPIRE_SECONDS = 365 * 24 * 60 * 60
+
+# Encode the signing key once instead of on every encode/decode
+_SECRET = settings.SECRET_KEY.encode()
+
+# API keys are HS256 JWTs signed directly with hmac. The header is the same
+# for every key, so it is encoded once; it matches PyJWT's (sorted keys), so
+# keys issued before keep verifying.
+_API_KEY_HEADER = base64.urlsafe_b64encode(b'{"alg":"HS256","typ":"JWT"}').rstrip(b"=")
+
+# Successful password checks, keyed by (sha256(plain), hash) so the plain
+# password itself is never kept in memory
+_password_cache: LRUCache = LRUCache(maxsize=4096)
+_password_cache_lock = threading.Lock()
+
+# Decoded API key payloads, keyed by the raw key, so repeat requests skip
+# signature verification
+_api_key_cache: TTLCache = TTLCache(maxsize=10000, ttl=60)
+_api_key_cache_lock = threading.Lock()
 
 def create_access_token(subject: str | Any, expires_delta: timedelta) -> str:
     """Create a JWT access token"""
-    expire = datetime.now(timezone.utc) + expires_delta
+    expire = int(time.time() + expires_delta.total_seconds())
     to_encode = {"exp": expire, "sub": str(subject)}
-    encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = jwt.encode(to_encode, _SECRET, algorithm=ALGORITHM)
     return encoded_jwt
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a plain password against its hash"""
-    return pwd_context.verify(plain_password, hashed_password)
+    key = (hashlib.sha256(plain_password.encode()).digest(), hashed_password)
+    with _password_cache_lock:
+        if key in _password_cache:
+            return True
+    if not pwd_context.verify(plain_password, hashed_password):
+        return False
+    with _password_cache_lock:
+        _password_cache[key] = True
+    return True
+
+def verify_and_update_password(plain_password: str, hashed_password: str) -> tuple[bool, Optional[str]]:
+    """Verify a password and return a new hash if the stored one is deprecated"""
+    if not verify_password(plain_password, hashed_password):
+        return False, None
+    if pwd_context.needs_update(hashed_password):
+        return True, pwd_context.hash(plain_password)
+    return True, None
 
 def get_password_hash(password: str) -> str:
     """Generate a password hash"""
     return pwd_context.hash(password)
 
+def _b64url_encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+def _b64url_decode(data: bytes) -> bytes:
+    return base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+
 def generate_api_key(user_id: str) -> str:
     """Generate a secure API key tied to a user"""
+    now = time.time()
     to_encode = {
         "user_id": user_id,
-        "iat": datetime.now(timezone.utc).timestamp(),
-        "exp": (datetime.now(timezone.utc) + timedelta(days=365)).timestamp()
+        "iat": now,
+        "exp": now + API_KEY_EXPIRE_SECONDS
     }
-    return jwt.encode(to_encode, settings.SECRET_KEY, algorithm=ALGORITHM)
+    msg = _API_KEY_HEADER + b"." + _b64url_encode(orjson.dumps(to_encode))
+    signature = _b64url_encode(hmac.new(_SECRET, msg, hashlib.sha256).digest())
+    return (msg + b"." + signature).decode()
 
 def verify_api_key(api_key: str) -> Optional[Dict]:
     """Verify an API key and return its payload"""
-    try:
-        payload = jwt.decode(api_key, settings.SECRET_KEY, algorithms=[ALGORITHM])
+    with _api_key_cache_lock:
+        payload = _api_key_cache.get(api_key)
+    if payload is not None:
         return payload
-    except JWTError:
-        return None
\ No newline at end of file
+    try:
+        msg, _, signature = api_key.encode().rpartition(b".")
+        header, _, encoded_payload = msg.partition(b".")
+        if header != _API_KEY_HEADER:
+            return None
+        expected = _b64url_encode(hmac.new(_SECRET, msg, hashlib.sha256).digest())
+        if not hmac.compare_digest(signature, expected):
+            return None
+        payload = orjson.loads(_b64url_decode(encoded_payload))
+        if not isinstance(payload, dict) or payload.get("exp", 0) <= time.time():
+            return None
+    except (ValueError, TypeError, orjson.JSONDecodeError):
+        return None
+    with _api_key_cache_lock:
+        _api_key_cache[api_key] = payload
+    return payload
+
+def invalidate_api_key(api_key: str) -> None:
+    """Drop an API key from the verification cache"""
+    with _api_key_cache_lock:
+        _api_key_cache.pop(api_key, None)
\ No newline at end of file
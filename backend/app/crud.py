@@ -16,7 +16,7 @@ from app.models import (
     Item,
     ItemCreate
 )
-from app.core.security import get_password_hash, verify_password
+from app.core.security import get_password_hash, verify_and_update_password
 
 
 # ✅ Ensure uniqueness before inserting
@@ -127,8 +127,17 @@ def get_user_by_email(session: Session, email: str) -> Optional[User]:
 def authenticate(session: Session, email: str, password: str) -> Optional[User]:
     """Authenticates a user by checking their password."""
     db_user = get_user_by_email(session=session, email=email)
-    if not db_user or not verify_password(password, db_user.hashed_password):
+    if not db_user:
         return None
+    verified, new_hash = verify_and_update_password(password, db_user.hashed_password)
+    if not verified:
+        return None
+    if new_hash:
+        # Move users off deprecated schemes (bcrypt) as they log in
+        db_user.hashed_password = new_hash
+        session.add(db_user)
+        session.commit()
+        session.refresh(db_user)
     return db_user
 
 
@@ -5,6 +5,7 @@ from starlette.middleware.cors import CORSMiddleware
 
 from app.api.main import api_router
 from app.core.config import settings
+from app.core.http import create_client
 
 
 def custom_generate_unique_id(route: APIRoute) -> str:
@@ -28,3 +29,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 app.include_router(api_router, prefix=settings.API_V1_STR)
+
+
+@app.on_event("startup")
+async def startup_proxy_client() -> None:
+    app.state.proxy_client = create_client()
+
+
+@app.on_event("shutdown")
+async def shutdown_proxy_client() -> None:
+    await app.state.proxy_client.aclose()
@@ -0,0 +1,357 @@
+import asyncio
+import itertools
+import time
+from collections.abc import Callable, Generator
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import inspect
+from sqlmodel import Session, select
+
+from app import crud
+from app.api.routes import proxy
+from app.api.routes.proxy import APIToken
+from app.core import security
+from app.core.config import settings
+from app.core.http import get_client
+from app.main import app
+from app.models import UserCreate
+from app.tests.utils.user import user_authentication_headers
+from app.tests.utils.utils import random_email, random_lower_string
+
+FETCH_RESULT = {
+    "result": "<html></html>",
+    "public_ip": "203.0.113.7",
+    "device_id": "abc",
+}
+
+
+def clear_caches() -> None:
+    proxy._health_cache.clear()
+    proxy._fetch_demotions.clear()
+    proxy._fetch_latency.clear()
+    proxy._user_cache.clear()
+    security._api_key_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def clear_proxy_caches() -> Generator[None, None, None]:
+    clear_caches()
+    yield
+    clear_caches()
+
+
+@pytest.fixture
+def mock_proxy_client() -> Generator[Callable[..., None], None, None]:
+    def install(handler: Callable[..., httpx.Response]) -> None:
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        app.dependency_overrides[get_client] = lambda: client
+
+    yield install
+    app.dependency_overrides.pop(get_client, None)
+
+
+@pytest.fixture
+def subscriber_headers(client: TestClient, db: Session) -> dict[str, str]:
+    email = random_email()
+    password = random_lower_string()
+    user_in = UserCreate(email=email, password=password, has_subscription=True)
+    crud.create_user(session=db, user_create=user_in)
+    return user_authentication_headers(client=client, email=email, password=password)
+
+
+def generate_api_key(client: TestClient, headers: dict[str, str]) -> str:
+    r = client.post(f"{settings.API_V1_STR}/proxy/generate-api-key", headers=headers)
+    assert r.status_code == 200
+    return r.json()["api_key"]
+
+
+def test_fetch_fails_over_to_next_endpoint(
+    client: TestClient,
+    subscriber_headers: dict[str, str],
+    mock_proxy_client: Callable[..., None],
+    db: Session,
+) -> None:
+    hosts = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        hosts.append(request.url.host)
+        if len(hosts) == 1:
+            raise httpx.ConnectError("connection refused", request=request)
+        if len(hosts) == 2:
+            return httpx.Response(502)
+        return httpx.Response(200, json=FETCH_RESULT)
+
+    mock_proxy_client(handler)
+    api_key = generate_api_key(client, subscriber_headers)
+    r = client.post(
+        f"{settings.API_V1_STR}/proxy/fetch",
+        params={"region": "us-east"},
+        headers={"x-api-key": api_key},
+        json={"url": "https://example.com"},
+    )
+    assert r.status_code == 200
+    content = r.json()
+    assert content["result"] == FETCH_RESULT["result"]
+    assert content["region_used"] == "us-east"
+    assert len(set(hosts)) == 3
+    token = db.exec(select(APIToken).where(APIToken.token == api_key)).one()
+    db.refresh(token)
+    assert token.request_count == 1
+
+
+def test_fetch_returns_503_when_all_endpoints_fail(
+    client: TestClient,
+    subscriber_headers: dict[str, str],
+    mock_proxy_client: Callable[..., None],
+) -> None:
+    hosts = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        hosts.append(request.url.host)
+        return httpx.Response(503)
+
+    mock_proxy_client(handler)
+    api_key = generate_api_key(client, subscriber_headers)
+    r = client.post(
+        f"{settings.API_V1_STR}/proxy/fetch",
+        params={"region": "us-east"},
+        headers={"x-api-key": api_key},
+        json={"url": "https://example.com"},
+    )
+    assert r.status_code == 503
+    assert sorted(hosts) == sorted(
+        httpx.URL(endpoint).host for endpoint in proxy.REGION_ENDPOINTS["us-east"]
+    )
+
+
+def test_fetch_prefers_faster_endpoint(
+    client: TestClient,
+    subscriber_headers: dict[str, str],
+    mock_proxy_client: Callable[..., None],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    # Start every rotation at the first endpoint so only latency decides
+    monkeypatch.setitem(proxy._region_counters, "us-east", itertools.repeat(0))
+    slow_host, fast_host = (
+        httpx.URL(endpoint).host for endpoint in proxy.REGION_ENDPOINTS["us-east"][:2]
+    )
+    hosts = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        hosts.append(request.url.host)
+        if request.url.host == slow_host:
+            await asyncio.sleep(0.1)
+        return httpx.Response(200, json=FETCH_RESULT)
+
+    mock_proxy_client(handler)
+    api_key = generate_api_key(client, subscriber_headers)
+    for _ in range(3):
+        r = client.post(
+            f"{settings.API_V1_STR}/proxy/fetch",
+            params={"region": "us-east"},
+            headers={"x-api-key": api_key},
+            json={"url": "https://example.com"},
+        )
+        assert r.status_code == 200
+    # The first call has no latency data and goes to the slow endpoint;
+    # after that the faster one leads
+    assert hosts == [slow_host, fast_host, fast_host]
+
+
+def test_fetch_does_not_fail_over_after_read_timeout(
+    client: TestClient,
+    subscriber_headers: dict[str, str],
+    mock_proxy_client: Callable[..., None],
+) -> None:
+    hosts = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        hosts.append(request.url.host)
+        raise httpx.ReadTimeout("target too slow", request=request)
+
+    mock_proxy_client(handler)
+    api_key = generate_api_key(client, subscriber_headers)
+    r = client.post(
+        f"{settings.API_V1_STR}/proxy/fetch",
+        params={"region": "europe"},
+        headers={"x-api-key": api_key},
+        json={"url": "https://example.com"},
+    )
+    assert r.status_code == 500
+    assert len(hosts) == 1
+    assert not proxy._fetch_demotions
+
+
+def test_fetch_failover_stops_at_deadline(
+    client: TestClient,
+    subscriber_headers: dict[str, str],
+    mock_proxy_client: Callable[..., None],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(proxy, "PROXY_FETCH_DEADLINE", 0.3)
+    hosts = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        hosts.append(request.url.host)
+        await asyncio.sleep(0.2)
+        return httpx.Response(502)
+
+    mock_proxy_client(handler)
+    api_key = generate_api_key(client, subscriber_headers)
+    start = time.monotonic()
+    r = client.post(
+        f"{settings.API_V1_STR}/proxy/fetch",
+        params={"region": "europe"},
+        headers={"x-api-key": api_key},
+        json={"url": "https://example.com"},
+    )
+    assert time.monotonic() - start < 2
+    assert r.status_code == 504
+    assert len(hosts) == 2
+
+
+def test_fetch_failures_do_not_mark_region_down_in_status(
+    client: TestClient,
+    subscriber_headers: dict[str, str],
+    mock_proxy_client: Callable[..., None],
+) -> None:
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith("/fetch"):
+            return httpx.Response(502)
+        return httpx.Response(200)
+
+    mock_proxy_client(handler)
+    api_key = generate_api_key(client, subscriber_headers)
+    r = client.post(
+        f"{settings.API_V1_STR}/proxy/fetch",
+        params={"region": "us-east"},
+        headers={"x-api-key": api_key},
+        json={"url": "https://example.com"},
+    )
+    assert r.status_code == 503
+    assert not proxy._health_cache
+
+    r = client.get(
+        f"{settings.API_V1_STR}/proxy/status",
+        params={"region": "us-east"},
+        headers={"x-api-key": api_key},
+    )
+    assert r.status_code == 200
+    status = r.json()["statuses"][0]
+    assert status["healthy_endpoints"] == status["total_endpoints"] == 3
+
+
+def test_fetch_invalid_region(
+    client: TestClient, subscriber_headers: dict[str, str]
+) -> None:
+    api_key = generate_api_key(client, subscriber_headers)
+    r = client.post(
+        f"{settings.API_V1_STR}/proxy/fetch",
+        params={"region": "atlantis"},
+        headers={"x-api-key": api_key},
+        json={"url": "https://example.com"},
+    )
+    assert r.status_code == 400
+
+
+def test_status_reports_slow_endpoints_unhealthy_at_deadline(
+    client: TestClient,
+    subscriber_headers: dict[str, str],
+    mock_proxy_client: Callable[..., None],
+) -> None:
+    slow_host = httpx.URL(proxy.REGION_ENDPOINTS["us-east"][0]).host
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.host == slow_host:
+            await asyncio.sleep(5)
+        return httpx.Response(200)
+
+    mock_proxy_client(handler)
+    api_key = generate_api_key(client, subscriber_headers)
+    start = time.monotonic()
+    r = client.get(
+        f"{settings.API_V1_STR}/proxy/status",
+        params={"region": "us-east"},
+        headers={"x-api-key": api_key},
+    )
+    assert time.monotonic() - start < 2
+    assert r.status_code == 200
+    status = r.json()["statuses"][0]
+    assert status["is_healthy"] is True
+    assert status["healthy_endpoints"] == 2
+    assert status["total_endpoints"] == 3
+
+
+def test_read_api_keys_skip_limit(
+    client: TestClient, subscriber_headers: dict[str, str]
+) -> None:
+    keys = [generate_api_key(client, subscriber_headers) for _ in range(3)]
+    r = client.get(
+        f"{settings.API_V1_STR}/proxy/api-keys",
+        params={"limit": 2},
+        headers=subscriber_headers,
+    )
+    assert r.status_code == 200
+    content = r.json()
+    assert len(content) == 2
+    newest = keys[-1]
+    assert content[0]["key_preview"] == f"{newest[:8]}...{newest[-8:]}"
+
+    r = client.get(
+        f"{settings.API_V1_STR}/proxy/api-keys",
+        params={"skip": 2, "limit": 2},
+        headers=subscriber_headers,
+    )
+    assert r.status_code == 200
+    content = r.json()
+    assert len(content) == 1
+    oldest = keys[0]
+    assert content[0]["key_preview"] == f"{oldest[:8]}...{oldest[-8:]}"
+
+
+def test_delete_api_key_evicts_cached_key(
+    client: TestClient, subscriber_headers: dict[str, str]
+) -> None:
+    api_key = generate_api_key(client, subscriber_headers)
+    r = client.get(
+        f"{settings.API_V1_STR}/proxy/regions", headers={"x-api-key": api_key}
+    )
+    assert r.status_code == 200
+    assert api_key in security._api_key_cache
+
+    r = client.delete(
+        f"{settings.API_V1_STR}/proxy/api-keys/{api_key[-8:]}",
+        headers=subscriber_headers,
+    )
+    assert r.status_code == 204
+    assert api_key not in security._api_key_cache
+
+
+def test_cached_api_key_user_is_detached_across_requests(
+    client: TestClient,
+    subscriber_headers: dict[str, str],
+    mock_proxy_client: Callable[..., None],
+) -> None:
+    mock_proxy_client(lambda request: httpx.Response(200, json=FETCH_RESULT))
+    api_key = generate_api_key(client, subscriber_headers)
+    # /fetch loads the user and then commits its session. The cached copy
+    # must not be expired by that commit, or later requests reading it
+    # would raise DetachedInstanceError.
+    r = client.post(
+        f"{settings.API_V1_STR}/proxy/fetch",
+        params={"region": "us-east"},
+        headers={"x-api-key": api_key},
+        json={"url": "https://example.com"},
+    )
+    assert r.status_code == 200
+    [user] = proxy._user_cache.values()
+    assert inspect(user).detached
+
+    for _ in range(2):
+        r = client.get(
+            f"{settings.API_V1_STR}/proxy/regions", headers={"x-api-key": api_key}
+        )
+        assert r.status_code == 200
+    assert list(proxy._user_cache.values()) == [user]
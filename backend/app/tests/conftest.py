@@ -4,6 +4,7 @@ import pytest
 from fastapi.testclient import TestClient
 from sqlmodel import Session, delete
 
+from app.api.routes.proxy import APIToken
 from app.core.config import settings
 from app.core.db import engine, init_db
 from app.main import app
@@ -19,6 +20,8 @@ def db() -> Generator[Session, None, None]:
         yield session
         statement = delete(Item)
         session.execute(statement)
+        statement = delete(APIToken)
+        session.execute(statement)
         statement = delete(User)
         session.execute(statement)
         session.commit()
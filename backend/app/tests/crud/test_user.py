@@ -1,3 +1,4 @@
+import bcrypt
 from fastapi.encoders import jsonable_encoder
 from sqlmodel import Session
 
@@ -26,6 +27,20 @@ def test_authenticate_user(db: Session) -> None:
     assert user.email == authenticated_user.email
 
 
+def test_authenticate_user_rehashes_bcrypt_password(db: Session) -> None:
+    email = random_email()
+    password = random_lower_string()
+    user_in = UserCreate(email=email, password=password)
+    user = crud.create_user(session=db, user_create=user_in)
+    user.hashed_password = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+    db.add(user)
+    db.commit()
+    authenticated_user = crud.authenticate(session=db, email=email, password=password)
+    assert authenticated_user
+    assert authenticated_user.hashed_password.startswith("$argon2id$")
+    assert verify_password(password, authenticated_user.hashed_password)
+
+
 def test_not_authenticate_user(db: Session) -> None:
     email = random_email()
     password = random_lower_string()